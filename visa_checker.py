@@ -2,17 +2,18 @@ import asyncio
 import os
 import base64
 import datetime
-import time
+import hashlib
+import functools
 import json
-
-from dotenv import load_dotenv
-load_dotenv()
+import random
+import signal
+from collections import OrderedDict
 
 # Import nodriver under the common alias `uc`
 import nodriver as uc
 
-# OpenAI client for captcha solving
-import openai
+# `dotenv` and `openai` (heavy: pydantic, httpx, ...) are imported lazily on
+# first use so the startup prompt appears without waiting on them.
 
 # Folder that will persist the Chromium/Chrome profile between runs.
 # This keeps cookies & local storage so the session remains logged in.
@@ -21,54 +22,87 @@ PROFILE_DIR = os.path.join(os.path.dirname(__file__), "visa_profile")
 # URL that shows appointment availability (or redirects to login if not authorised)
 APPOINTMENT_URL = "https://www.usvisascheduling.com/schedule/?reschedule=true"
 
-# URL that our in-page hook will ping when it detects available slots
-# Will be constructed from credentials (telegram_bot_token/chat_id) or environment.
-NOTIFY_URL = None
+# Async OpenAI client, created on first captcha solve (see _get_openai)
+_openai = None
 
 # Global retry configuration
 MAX_RETRIES = 5
-RETRY_DELAY_SECONDS = 2
+RETRY_BASE_DELAY_SECONDS = 0.25
+RETRY_MAX_DELAY_SECONDS = 30
+
+# Number of distinct captcha images whose solve attempts are remembered
+CAPTCHA_REGISTRY_SIZE = 256
 
 _cred_path = os.path.join(os.path.dirname(__file__), "credential.json")
-try:
-    with open(_cred_path, "r", encoding="utf-8") as _f:
-        _credential_data = json.load(_f)
-except Exception as _e:
-    print(f"[ERROR] Could not read credential.json – {_e}")
-    _credential_data = {}
-
-# Basic credential fields
-USERNAME = _credential_data.get("username")
-PASSWORD = _credential_data.get("password")
-
-# Map security question input selectors (e.g., #kba1_response) to answers.
-SECURITY_ANSWERS = {
-    q.get("tag"): q.get("answer") for q in _credential_data.get("security_questions", []) if q.get("tag") and q.get("answer")
-}
+
+
+@functools.lru_cache(maxsize=1)
+def _load_env():
+    """Load variables from a .env file into the environment (once)."""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+@functools.lru_cache(maxsize=1)
+def _creds() -> dict:
+    """Parse credential.json on first use. Returns an empty dict if unreadable."""
+    _load_env()
+    try:
+        with open(_cred_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[ERROR] Could not read credential.json – {e}")
+        return {}
+
+
+def _security_answers() -> dict:
+    """Map security question input selectors (e.g., #kba1_response) to answers."""
+    return {
+        q.get("tag"): q.get("answer") for q in _creds().get("security_questions", []) if q.get("tag") and q.get("answer")
+    }
+
 
 # Path to persist user's preferred date range for slot notifications
 SLOT_PREFS_PATH = os.path.join(os.path.dirname(__file__), "slot_prefs.json")
 
-# Build NOTIFY_URL from credentials or environment variables
-if not NOTIFY_URL:
-    tg_token = _credential_data.get('telegram_bot_token') or os.getenv('TELEGRAM_BOT_TOKEN')
-    tg_chat = _credential_data.get('telegram_chat_id') or os.getenv('TELEGRAM_CHAT_ID')
+# Last slot preferences read from disk, keyed by the file's mtime
+_prefs_cache = {"mtime": 0, "data": None}
+
+
+@functools.lru_cache(maxsize=1)
+def _notify_url() -> str:
+    """URL that our in-page hook will ping when it detects available slots.
+
+    Built from credentials (telegram_bot_token/chat_id) or environment variables.
+    """
+    creds = _creds()
+    tg_token = creds.get('telegram_bot_token') or os.getenv('TELEGRAM_BOT_TOKEN')
+    tg_chat = creds.get('telegram_chat_id') or os.getenv('TELEGRAM_CHAT_ID')
     if tg_token and tg_chat:
-        NOTIFY_URL = f"https://api.telegram.org/bot{tg_token}/sendMessage?chat_id={tg_chat}&text=hasSlot"
-    else:
-        # Keep a non-functional placeholder to avoid None checks later
-        NOTIFY_URL = "https://api.telegram.org/bot<TELEGRAM_API_KEY>/sendMessage?chat_id=<CHAT_ID>&text=hasSlot"
+        return f"https://api.telegram.org/bot{tg_token}/sendMessage?chat_id={tg_chat}&text=hasSlot"
+    # Keep a non-functional placeholder to avoid None checks later
+    return "https://api.telegram.org/bot<TELEGRAM_API_KEY>/sendMessage?chat_id=<CHAT_ID>&text=hasSlot"
 
 
 def load_slot_prefs():
-    """Load slot preferences from disk. Returns dict with 'start_date' and 'end_date' or None."""
+    """Load slot preferences from disk. Returns dict with 'start_date' and 'end_date' or None.
+
+    The parsed file is cached and only re-read when its mtime changes.
+    """
     try:
-        if os.path.exists(SLOT_PREFS_PATH):
-            with open(SLOT_PREFS_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            # Return whatever is on disk. The presence of the file signals the
-            # user's previous choice; empty strings mean 'no filtering'.
-            return data
+        mtime = os.stat(SLOT_PREFS_PATH).st_mtime
+    except OSError:
+        return None
+    if _prefs_cache["data"] is not None and _prefs_cache["mtime"] == mtime:
+        return _prefs_cache["data"]
+    try:
+        with open(SLOT_PREFS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        _prefs_cache["mtime"] = mtime
+        _prefs_cache["data"] = data
+        # Return whatever is on disk. The presence of the file signals the
+        # user's previous choice; empty strings mean 'no filtering'.
+        return data
     except Exception as e:
         print(f"[WARN] Could not read slot prefs file – {e}")
     return None
@@ -100,35 +134,33 @@ async def start_browser():
 
 
 async def is_login_required(page) -> bool:
-    """Best-effort heuristic to decide whether the current page is a login page."""
+    """Best-effort heuristic to decide whether the current page is a login page.
+
+    The URL and the password-field check are read in one JS evaluation, so
+    both describe the same document.
+    """
+    info = await page.evaluate(
+        "JSON.stringify({url: location.href, hasPwd: !!document.querySelector('input[type=password]')})"
+    )
     try:
-        current_url = page.url  # Works on recent nodriver versions
-    except AttributeError:
-        # Fallback: query location.href via JS evaluation
-        current_url = await page.evaluate("location.href")
+        d = json.loads(info)
+    except (TypeError, ValueError):
+        return False
 
     # If we are on the Microsoft B2C login domain, we clearly need to log in.
-    if current_url and "b2clogin.com" in current_url:
-        return True
-
-    # Additional heuristic: look for password input on the page.
-    pwd_field = await page.select("input[type=password]")
-    if pwd_field:
-        return True
-
-    return False
+    # Otherwise, a password input on the page is a strong hint too.
+    return "b2clogin.com" in (d.get("url") or "") or bool(d.get("hasPwd"))
 
 
 async def is_waiting_room(page) -> bool:
     """Return True if the current page is the high-traffic waiting room.
 
     The waiting room page shows an inline background image on the <body> tag
-    that points to `waiting_room_background_en-US.png`. We inspect the body
-    style attribute to look for that filename.
+    that points to `waiting_room_background_en-US.png`. We match it with a CSS
+    attribute selector in a single JS evaluation that returns a boolean.
     """
     try:
-        style_attr = await page.evaluate("document.body && document.body.getAttribute('style')")
-        if style_attr and "waiting_room_background_en-US.png" in style_attr:
+        if await page.evaluate("!!document.querySelector(\"body[style*='waiting_room_background_en-US.png']\")") is True:
             return True
     except Exception:
         # In case DOM access fails (e.g. frame navigations), treat as not waiting room.
@@ -136,118 +168,204 @@ async def is_waiting_room(page) -> bool:
     return False
 
 
-async def inject_fetch_hook(page):
-    # Try to load persisted slot preferences from disk (the Python side will
-    # embed them into the hook script). If not present, the variables will be
-    # empty strings and the hook will behave as before (notify on any slot).
-    prefs = load_slot_prefs() or {}
-    start_date = prefs.get("start_date", "")
-    end_date = prefs.get("end_date", "")
-
-    hook_js = """
-    (function() {
+# In-page script that hooks fetch/XHR to watch the schedule-days endpoint.
+# Literal JS braces are doubled so the placeholders can be filled with
+# str.format().
+_HOOK_TEMPLATE = """
+    (function() {{
         if (window.__APPT_HOOK_INSTALLED__) return;  // Guard against duplicates
         window.__APPT_HOOK_INSTALLED__ = true;
 
         const TARGET_SUBSTR = '/custom-actions/?route=/api/v1/schedule-group/get-family-consular-schedule-days';
-    const NOTIFY_URL   = '%s';
-    const REFRESH_URL  = '%s';
-    const START_DATE   = '%s';
-    const END_DATE     = '%s';
+    const NOTIFY_URL   = '{notify}';
+    const REFRESH_URL  = '{refresh}';
+    const START_DATE   = '{start}';
+    const END_DATE     = '{end}';
+    const POLL_INTERVAL_MS = 300000;
 
-        function analyseAvailability(json) {
+        // First request seen for TARGET_SUBSTR; replayed by the in-page poll.
+        let capturedRequest = null;
+
+        function analyseAvailability(json) {{
             let hasSlots = false;
-            try {
-                try { console.log('[HOOK] ScheduleDays payload:', json && json.ScheduleDays); } catch(e) {}
+            try {{
+                try {{ console.log('[HOOK] ScheduleDays payload:', json && json.ScheduleDays); }} catch(e) {{}}
 
                 // If START_DATE and END_DATE are set, filter ScheduleDays to see if
                 // any date falls within the inclusive range. Dates from the API are
                 // in YYYY-MM-DD format so simple string -> Date parsing works.
-                if (START_DATE && END_DATE && Array.isArray(json?.ScheduleDays)) {
+                if (START_DATE && END_DATE && Array.isArray(json?.ScheduleDays)) {{
                     const s = new Date(START_DATE + 'T00:00:00');
                     const e = new Date(END_DATE + 'T23:59:59');
-                    const matches = json.ScheduleDays.filter(d => {
-                        try {
+                    const matches = json.ScheduleDays.filter(d => {{
+                        try {{
                             const dt = new Date(d.Date + 'T00:00:00');
                             return dt >= s && dt <= e;
-                        } catch (ex) { return false; }
-                    });
+                        }} catch (ex) {{ return false; }}
+                    }});
                     hasSlots = matches.length > 0;
-                    try { console.log('[HOOK] Matching dates in range:', matches); } catch(_) {}
-                } else {
+                    try {{ console.log('[HOOK] Matching dates in range:', matches); }} catch(_) {{}}
+                }} else {{
                     hasSlots = Array.isArray(json?.ScheduleDays) && json.ScheduleDays.length > 0;
-                }
-            } catch (e) {}
+                }}
+            }} catch (e) {{}}
 
-            if (hasSlots) {
+            if (hasSlots) {{
                 console.log('[HOOK] Appointment slots AVAILABLE! Notifying\u2026');
-                fetch(NOTIFY_URL, { method: 'GET', mode: 'no-cors' }).catch(()=>{});
-            } else {
+                fetch(NOTIFY_URL, {{ method: 'GET', mode: 'no-cors' }}).catch(()=>{{}});
+            }} else {{
                 console.log('[HOOK] No appointment slots at this time.');
-            }
-
-            // Refresh in 5 s regardless so we keep polling.
-            setTimeout(() => { location.href = REFRESH_URL; }, 300000);
-        }
+            }}
+
+            // Re-issue the captured request every 5 min from within the page
+            // instead of reloading it. Fall back to a full reload only if the
+            // in-page poll breaks (e.g. the session expired).
+            if (!window.__APPT_POLL__ && capturedRequest) {{
+                window.__APPT_POLL__ = setInterval(async () => {{
+                    try {{
+                        const r = await origFetch(capturedRequest.url, {{
+                            method: capturedRequest.method,
+                            body: capturedRequest.body,
+                            headers: Object.assign({{ 'Accept': 'application/json' }}, capturedRequest.headers),
+                            credentials: 'include',
+                        }});
+                        if (!r.ok) throw new Error(r.status);
+                        analyseAvailability(await r.json());
+                    }} catch (e) {{
+                        console.error('[HOOK] In-page poll failed, reloading', e);
+                        location.href = REFRESH_URL;
+                    }}
+                }}, POLL_INTERVAL_MS);
+            }}
+        }}
 
         /* ---------- Hook `fetch` ---------- */
         const origFetch = window.fetch;
-        window.fetch = async (...args) => {
+        window.fetch = async (...args) => {{
             const res = await origFetch(...args);
-            try {
+            try {{
                 const url = (args[0]?.toString()) || '';
-                if (url.includes(TARGET_SUBSTR)) {
+                if (url.includes(TARGET_SUBSTR)) {{
                     console.log('[HOOK] Captured fetch →', url);
-                    res.clone().json().then(analyseAvailability).catch(()=>{});
-                }
-            } catch(e) { console.error('[HOOK] fetch hook error', e); }
+                    if (!capturedRequest) {{
+                        const init = args[1] || {{}};
+                        capturedRequest = {{ url, method: init.method || 'GET', body: init.body, headers: Object.fromEntries(new Headers(init.headers || {{}})) }};
+                    }}
+                    res.clone().json().then(analyseAvailability).catch(()=>{{}});
+                }}
+            }} catch(e) {{ console.error('[HOOK] fetch hook error', e); }}
             return res;
-        };
+        }};
 
         /* ---------- Hook `XMLHttpRequest` ---------- */
         const origOpen = XMLHttpRequest.prototype.open;
-        XMLHttpRequest.prototype.open = function(method, url, ...rest) {
+        XMLHttpRequest.prototype.open = function(method, url, ...rest) {{
             this.__hooked_url__ = url;
+            this.__hooked_method__ = method;
+            this.__hooked_headers__ = {{}};
             return origOpen.call(this, method, url, ...rest);
-        };
+        }};
+
+        const origSetHeader = XMLHttpRequest.prototype.setRequestHeader;
+        XMLHttpRequest.prototype.setRequestHeader = function(name, value) {{
+            if (this.__hooked_headers__) this.__hooked_headers__[name] = value;
+            return origSetHeader.call(this, name, value);
+        }};
 
         const origSend = XMLHttpRequest.prototype.send;
-        XMLHttpRequest.prototype.send = function(...sArgs) {
-            this.addEventListener('load', () => {
-                try {
+        XMLHttpRequest.prototype.send = function(...sArgs) {{
+            this.addEventListener('load', () => {{
+                try {{
                     const url = this.__hooked_url__ || '';
-                    if (url.includes(TARGET_SUBSTR)) {
+                    if (url.includes(TARGET_SUBSTR)) {{
                         console.log('[HOOK] Captured XHR →', url);
-                        try {
+                        if (!capturedRequest) {{
+                            capturedRequest = {{
+                                url: new URL(url, location.href).toString(),
+                                method: this.__hooked_method__ || 'GET',
+                                body: sArgs[0],
+                                headers: this.__hooked_headers__ || {{}},
+                            }};
+                        }}
+                        try {{
                             const data = JSON.parse(this.responseText);
                             analyseAvailability(data);
-                        } catch (ex) {
+                        }} catch (ex) {{
                             console.error('[HOOK] Could not parse XHR JSON', ex);
-                        }
-                    }
-                } catch(err) { console.error('[HOOK] XHR hook error', err); }
-            });
+                        }}
+                    }}
+                }} catch(err) {{ console.error('[HOOK] XHR hook error', err); }}
+            }});
             return origSend.apply(this, sArgs);
-        };
-    })();
-    """ % (NOTIFY_URL, APPOINTMENT_URL, start_date, end_date)
+        }};
+    }})();
+"""
+
+
+async def _is_hook_installed(page) -> bool:
+    """Cheap probe for the hook's install guard in the current JS context."""
+    return await page.evaluate("window.__APPT_HOOK_INSTALLED__ === true") is True
+
+
+async def _install_hook(page):
+    # Embed the persisted slot preferences into the hook script. If not
+    # present, the variables will be empty strings and the hook will behave
+    # as before (notify on any slot).
+    prefs = load_slot_prefs() or {}
+    hook_js = _HOOK_TEMPLATE.format(
+        notify=_notify_url(),
+        refresh=APPOINTMENT_URL,
+        start=prefs.get("start_date", ""),
+        end=prefs.get("end_date", ""),
+    )
 
     await page.evaluate(hook_js)
 
 
-async def _ensure_fetch_hook(page, interval: int = 3):
-    """Background task: periodically (every `interval` s) try to inject the fetch
-    hook.  This keeps the hook alive across page reloads, since each reload
-    clears the previous JS context.  The injected script is idempotent so doing
-    this repeatedly is safe.
+async def inject_fetch_hook(page):
+    """Install the fetch/XHR hook unless the current page already has it, so
+    the full script is only sent over CDP when actually needed."""
+    if not await _is_hook_installed(page):
+        await _install_hook(page)
+
+
+async def _ensure_fetch_hook(page):
+    """Inject the fetch hook now and register handlers that inject it again
+    after every navigation of the top-level frame, since each navigation
+    clears the previous JS context.  The injected script is idempotent so
+    re-running it is safe.  The handlers live on the page, so this returns
+    once they are registered.
     """
 
-    while True:
+    async def _reinject(event):
+        # Sub-frame navigations (iframes) keep the top-level hook intact.
+        if isinstance(event, uc.cdp.page.FrameNavigated) and event.frame.parent_id:
+            return
         try:
             await inject_fetch_hook(page)
         except Exception as e:
             print(f"[WARN] Fetch-hook injection attempt failed – {e}")
-        await asyncio.sleep(interval)
+
+    page.add_handler([uc.cdp.page.FrameNavigated, uc.cdp.page.LoadEventFired], _reinject)
+
+    # Initial injection for the page we are already on. This also sends a CDP
+    # command, which makes nodriver enable the Page domain for the handlers.
+    await _reinject(None)
+
+
+def _retry_delay(attempt: int) -> float:
+    """Exponential back-off with jitter for the given (0-based) retry attempt."""
+    return min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt)) + random.uniform(0, RETRY_BASE_DELAY_SECONDS)
+
+
+# Draws an <img> onto a canvas and returns its PNG encoding as bare base64.
+_CAPTCHA_TO_BASE64_JS = """(el) => {
+    const c = document.createElement("canvas");
+    c.width = el.naturalWidth;
+    c.height = el.naturalHeight;
+    c.getContext("2d").drawImage(el, 0, 0);
+    return c.toDataURL("image/png").split(",")[1];
+}"""
 
 
 async def _extract_captcha_data_url(page) -> str | None:
@@ -259,7 +377,7 @@ async def _extract_captcha_data_url(page) -> str | None:
             captcha_img = await page.select("#captchaImage", timeout=5)
             if not captcha_img:
                 print(f"[INFO] Captcha image not found on attempt {attempt + 1}/{MAX_RETRIES}.")
-                await asyncio.sleep(RETRY_DELAY_SECONDS)
+                await asyncio.sleep(_retry_delay(attempt))
                 continue
 
             # Check if the image is loaded by inspecting the 'src' attribute
@@ -267,34 +385,28 @@ async def _extract_captcha_data_url(page) -> str | None:
             src = await captcha_img.apply('(el) => el.getAttribute("src")')
             if not src or src.startswith("data:image/gif"): # Placeholder images are often GIFs
                 print(f"[INFO] Captcha image not fully loaded on attempt {attempt + 1}/{MAX_RETRIES}. Retrying...")
-                await asyncio.sleep(RETRY_DELAY_SECONDS)
+                await asyncio.sleep(_retry_delay(attempt))
                 continue
 
             # Re-verify element still exists before screenshot
             if not captcha_img:
                 print(f"[WARN] Captcha element became None before screenshot on attempt {attempt + 1}/{MAX_RETRIES}")
-                await asyncio.sleep(RETRY_DELAY_SECONDS)
+                await asyncio.sleep(_retry_delay(attempt))
                 continue
 
-            # Use nodriver's element screenshot method to capture the image
-            ts = datetime.datetime.now(datetime.UTC).strftime("%Y%m%d_%H%M%S_%f")
-            temp_path = os.path.join(os.path.dirname(__file__), f"temp_captcha_{ts}.png")
-
-            # Save screenshot of the captcha element
-            await captcha_img.save_screenshot(filename=temp_path, format="png")
-
-            # Read the file and convert to base64 data URL
-            with open(temp_path, "rb") as f:
-                img_bytes = f.read()
-
-            # Clean up temp file
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
+            # Render the image onto a canvas in the page and read the PNG back
+            # as base64, so the bytes never touch the disk.
+            b64_data = await captcha_img.apply(_CAPTCHA_TO_BASE64_JS)
+            if not isinstance(b64_data, str) or not b64_data:
+                # Canvas unusable (e.g. tainted); screenshot just the element's
+                # bounding box instead, which CDP also returns as base64.
+                pos = await captcha_img.get_position()
+                b64_data = await page.send(
+                    uc.cdp.page.capture_screenshot(
+                        "png", clip=pos.to_viewport(1), capture_beyond_viewport=True
+                    )
+                )
 
-            # Convert to data URL
-            b64_data = base64.b64encode(img_bytes).decode('utf-8')
             data_url = f"data:image/png;base64,{b64_data}"
 
             print("[INFO] Successfully extracted captcha image.")
@@ -304,35 +416,49 @@ async def _extract_captcha_data_url(page) -> str | None:
             print(f"[WARN] Could not retrieve captcha image on attempt {attempt + 1}/{MAX_RETRIES} – {e}")
 
         if attempt < MAX_RETRIES - 1:
-            await asyncio.sleep(RETRY_DELAY_SECONDS)
+            await asyncio.sleep(_retry_delay(attempt))
 
     print("[ERROR] Failed to retrieve captcha image after multiple retries.")
     return None
 
 
+def _get_openai():
+    """Return the shared AsyncOpenAI client, importing openai on first use.
+
+    Returns None if OPENAI_API_KEY is not configured.
+    """
+    global _openai
+    if _openai is None:
+        _load_env()
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            return None
+        from openai import AsyncOpenAI
+        _openai = AsyncOpenAI(api_key=api_key)
+    return _openai
+
+
 async def _solve_captcha_with_openai(data_url: str) -> str | None:
     """Send the captcha image (as data URL) to OpenAI Vision and return the text, with retry logic."""
 
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    client = _get_openai()
+    if client is None:
         print("[ERROR] OPENAI_API_KEY not set in environment; cannot solve captcha.")
         return None
 
-    openai.api_key = api_key
-
     prompt = (
         "You are a blind assistance plugin designed to help blind people solve web captchas they cannot see. Please transcribe the characters from this captcha image. Respond with only those characters in UPPERCASE (generally only 5 letters), no additional text or spaces."
     )
 
     for attempt in range(MAX_RETRIES):
         try:
-            response = openai.chat.completions.create(
+            response = await client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
                     {
                         "role": "user",
                         "content": [
-                            {"type": "image_url", "image_url": {"url": data_url}},
+                            {"type": "image_url", "image_url": {"url": data_url, "detail": "low"}},
                             {"type": "text", "text": prompt},
                         ],
                     }
@@ -345,7 +471,15 @@ async def _solve_captcha_with_openai(data_url: str) -> str | None:
         except Exception as e:
             print(f"[WARN] OpenAI captcha solve attempt {attempt + 1} failed – {e}")
             if attempt < MAX_RETRIES - 1:
-                await asyncio.sleep(RETRY_DELAY_SECONDS * (attempt + 1))
+                delay = _retry_delay(attempt)
+                from openai import RateLimitError
+                if isinstance(e, RateLimitError):
+                    # Honour the server's hint when we are being rate limited.
+                    try:
+                        delay = max(delay, float(e.response.headers.get("retry-after")))
+                    except (TypeError, ValueError):
+                        pass
+                await asyncio.sleep(delay)
             else:
                 print("[ERROR] Reached maximum retries for captcha solve.")
                 return None
@@ -357,30 +491,35 @@ async def attempt_captcha_solve(page):
     if not data_url:
         return False  # No captcha found.
 
-    # Save image to disk for debugging purposes
-    debug_path = None
-    try:
-        header, b64_data = data_url.split(",", 1)
-        img_bytes = base64.b64decode(b64_data)
-        ts = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
-        debug_path = os.path.join(os.path.dirname(__file__), f"captcha_{ts}.png")
-        with open(debug_path, "wb") as f:
-            f.write(img_bytes)
-        print(f"[DEBUG] Captcha image saved to {debug_path}")
-    except Exception as e:
-        print(f"[WARN] Could not save captcha debug image – {e}")
+    # Optionally keep a copy of the image on disk for debugging. This is the
+    # only place the base64 payload is decoded back to bytes.
+    if os.getenv("CAPTCHA_DEBUG"):
+        try:
+            img_bytes = base64.b64decode(data_url.split(",", 1)[1])
+            ts = datetime.datetime.now(datetime.UTC).strftime("%Y%m%d_%H%M%S_%f")
+            debug_path = os.path.join(os.path.dirname(__file__), f"captcha_{ts}.png")
+            with open(debug_path, "wb") as f:
+                f.write(img_bytes)
+            print(f"[DEBUG] Captcha image saved to {debug_path}")
+        except Exception as e:
+            print(f"[WARN] Could not save captcha debug image – {e}")
 
     # Limit number of OpenAI calls for the same captcha image to avoid loops
+    # (keyed by a short digest of the image, oldest entries evicted first).
     if not hasattr(attempt_captcha_solve, "_attempt_registry"):
-        attempt_captcha_solve._attempt_registry = {}
+        attempt_captcha_solve._attempt_registry = OrderedDict()
 
     registry = attempt_captcha_solve._attempt_registry
-    attempts = registry.get(data_url, 0)
+    key = hashlib.blake2b(data_url.encode(), digest_size=16).hexdigest()
+    attempts = registry.get(key, 0)
     if attempts >= MAX_RETRIES:
         print("[INFO] Max attempts reached for this captcha image, skipping further solves.")
         return False
 
-    registry[data_url] = attempts + 1
+    registry[key] = attempts + 1
+    registry.move_to_end(key)
+    if len(registry) > CAPTCHA_REGISTRY_SIZE:
+        registry.popitem(last=False)
 
     captcha_text = await _solve_captcha_with_openai(data_url)
     if not captcha_text:
@@ -394,13 +533,6 @@ async def attempt_captcha_solve(page):
 
     await resp_input.send_keys(captcha_text)
     print("[INFO] Captcha response filled.")
-    # Remove debug captcha image to avoid disk accumulation
-    try:
-        if debug_path and os.path.exists(debug_path):
-            os.unlink(debug_path)
-            print(f"[DEBUG] Removed captcha debug image {debug_path}")
-    except Exception:
-        pass
 
     return True
 
@@ -415,43 +547,88 @@ async def _wait_for_element(page, selector: str, max_attempts: int = 10, delay:
     return None
 
 
+async def _set_value(el, value: str):
+    """Utility: set an input's value in one JS call and fire the input/change
+    events the page listens for, instead of typing it key by key."""
+    await el.apply(
+        f'(el) => {{ el.value = {json.dumps(value)};'
+        ' el.dispatchEvent(new Event("input", {bubbles: true}));'
+        ' el.dispatchEvent(new Event("change", {bubbles: true})); }'
+    )
+
+
+async def _probe_selectors(page, selectors) -> list[bool]:
+    """Utility: report which selectors currently match, using a single JS
+    evaluation. Returns all False if the page cannot be queried."""
+    probe = "JSON.stringify([" + ",".join(f"!!document.querySelector({json.dumps(s)})" for s in selectors) + "])"
+    try:
+        return [bool(found) for found in json.loads(await page.evaluate(probe))]
+    except Exception:
+        return [False] * len(selectors)
+
+
+async def _resolve_selectors(page, selectors) -> list:
+    """Utility: resolve element handles for several selectors against a single
+    DOM.getDocument snapshot, so only one document tree crosses CDP."""
+    doc = await page.send(uc.cdp.dom.get_document(-1, True))
+    return [await page.query_selector(s, _node=doc) for s in selectors]
+
+
+async def _wait_for_all(page, selectors, timeout: float = 10, delay: float = 0.2):
+    """Utility: wait until every selector matches, checking all of them in a
+    single JS evaluation per poll, then resolve the element handles.
+
+    Returns a list of elements in selector order, or a list of Nones on timeout.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        if all(await _probe_selectors(page, selectors)):
+            return await _resolve_selectors(page, selectors)
+        if loop.time() >= deadline:
+            return [None] * len(selectors)
+        await asyncio.sleep(delay)
+
+
 async def perform_login(page) -> bool:
     """Attempt to perform the two-step login flow automatically.
 
     Returns True if login appears successful (navigates back to main site), else False.
     """
 
-    if not USERNAME or not PASSWORD:
+    creds = _creds()
+    username = creds.get("username")
+    password = creds.get("password")
+    if not username or not password:
         print("[ERROR] Username or password not configured; cannot perform automated login.")
         return False
 
     # ---------------- First screen: username / password / captcha ----------------
     print("[INFO] Filling username & password on first login screen…")
 
-    username_input = await _wait_for_element(page, "#signInName")
-    password_input = await _wait_for_element(page, "#password")
-    continue_btn = await _wait_for_element(page, "#continue")
+    username_input, password_input, continue_btn = await _wait_for_all(
+        page, ("#signInName", "#password", "#continue")
+    )
 
     if not username_input or not password_input or not continue_btn:
         print("[WARN] Could not locate essential elements on the first login screen.")
         return False
 
-    # Clear existing values (best-effort)
-    try:
-        await username_input.apply('(el) => { el.value = ""; }')
-    except Exception:
-        pass
-    try:
-        await password_input.apply('(el) => { el.value = ""; }')
-    except Exception:
-        pass
+    # Solve captcha if present. Start it first so the OpenAI round-trip runs
+    # while the credentials are filled in.
+    captcha_task = asyncio.create_task(attempt_captcha_solve(page))
 
-    # Type credentials
-    await username_input.send_keys(USERNAME)
-    await password_input.send_keys(PASSWORD)
+    # Fill credentials (replaces any existing values)
+    try:
+        await _set_value(username_input, username)
+        await _set_value(password_input, password)
+    except Exception as e:
+        # Don't leave the solve running to type into the page later on.
+        captcha_task.cancel()
+        print(f"[WARN] Could not fill credentials on the first login screen – {e}")
+        return False
 
-    # Solve captcha if present
-    await attempt_captcha_solve(page)
+    await captcha_task
 
     # Click continue to move to security questions screen
     await continue_btn.click()
@@ -461,56 +638,66 @@ async def perform_login(page) -> bool:
 
     # Wait until BOTH of the two security-question inputs (kba*) appear.
     # Per product behaviour, exactly two of the three possible inputs are rendered each login.
+    kba_selectors = ("#kba1_response", "#kba2_response", "#kba3_response")
+    # Check all three in one JS evaluation; one of them is always absent, so
+    # per-selector waits would pay a full timeout on every pass.
     for attempt in range(30):  # give a bit more time
-        kba_inputs: dict[str, any] = {}
-        for selector in ("#kba1_response", "#kba2_response", "#kba3_response"):
-            el = await page.select(selector)
-            if el:
-                kba_inputs[selector] = el
+        present = await _probe_selectors(page, kba_selectors)
 
-        if len(kba_inputs) >= 2:
-            break  # found both inputs
+        if sum(present) >= 2:
+            found = [sel for sel, ok in zip(kba_selectors, present) if ok]
+            handles = await _resolve_selectors(page, found)
+            kba_inputs: dict[str, any] = {sel: el for sel, el in zip(found, handles) if el}
+            if len(kba_inputs) >= 2:
+                break  # found both inputs
 
-        time.sleep(1)
+        await asyncio.sleep(1)
     else:
         print("[ERROR] Timed out waiting for the two security question inputs to appear.")
         return False
 
     # Fill answers for whichever questions appeared.
     print("[INFO] Filling security question answers…")
+    security_answers = _security_answers()
     for selector, el in kba_inputs.items():
-        answer = SECURITY_ANSWERS.get(selector)
+        answer = security_answers.get(selector)
         if not answer:
             print(f"[WARN] No configured answer for {selector}; leaving blank.")
             continue
-        try:
-            await el.apply('(el) => { el.value = ""; }')
-        except Exception:
-            pass
-        await el.send_keys(answer)
+        await _set_value(el, answer)
 
     # Click continue again to submit answers
     continue_btn2 = await _wait_for_element(page, "#continue")
     if not continue_btn2:
         print("[WARN] Could not locate continue button on security question screen.")
         return False
-    await continue_btn2.click()
 
-    # ---------------- Verify login success ----------------
-    print("[INFO] Waiting for navigation back to scheduling site…")
-    for attempt in range(30):
-        try:
-            current_url = await page.evaluate("location.href")
-        except AttributeError:
-            current_url = page.url
+    # Watch top-level navigations so we learn about the redirect back to the
+    # scheduling site as soon as it happens, instead of polling the URL.
+    navigated_back = asyncio.Event()
 
-        if current_url and "usvisascheduling.com" in current_url and "b2clogin.com" not in current_url:
-            print("[INFO] Automated login appears successful.")
-            return True
-        time.sleep(1)
+    def _on_frame_navigated(event):
+        url = event.frame.url or ""
+        if not event.frame.parent_id and "usvisascheduling.com" in url and "b2clogin.com" not in url:
+            navigated_back.set()
 
-    print("[ERROR] Automated login did not complete within expected time.")
-    return False
+    page.add_handler(uc.cdp.page.FrameNavigated, _on_frame_navigated)
+    try:
+        await continue_btn2.click()
+
+        # ---------------- Verify login success ----------------
+        print("[INFO] Waiting for navigation back to scheduling site…")
+        await asyncio.wait_for(navigated_back.wait(), timeout=30)
+    except asyncio.TimeoutError:
+        print("[ERROR] Automated login did not complete within expected time.")
+        return False
+    finally:
+        # Drop only our callback; Tab.remove_handler() clears every handler
+        # registered for the event type.
+        page.handlers[uc.cdp.page.FrameNavigated].remove(_on_frame_navigated)
+
+    print("[INFO] Automated login appears successful.")
+    return True
 
 
 async def main():
@@ -550,7 +737,7 @@ async def main():
     # If the site places us in a high-traffic waiting room, patiently wait until we are released.
     while await is_waiting_room(page):
         print("[INFO] Waiting room detected – site is congested. Retrying in 5 seconds...")
-        time.sleep(5)
+        await asyncio.sleep(5)
 
     # After we pass the waiting room (or if we never entered it), continue with normal flow.
 
@@ -569,29 +756,41 @@ async def main():
             # If we end up in the waiting room after login, continue polling until we can proceed.
             while await is_waiting_room(page):
                 print("[INFO] Waiting room detected after login – site is congested. Retrying in 5 seconds...")
-                time.sleep(5)
+                await asyncio.sleep(5)
 
     try:
         # Redirect the current tab back to the appointment page in case
         # the post-login redirect took the user elsewhere (e.g. a home
-        # dashboard).
-        await page.evaluate(f"window.location.assign('{APPOINTMENT_URL}')")
+        # dashboard). Skip the reload if we already landed there.
+        current_url = await page.evaluate("location.href")
+        if APPOINTMENT_URL not in (current_url or ""):
+            await page.evaluate(f"window.location.assign('{APPOINTMENT_URL}')")
 
-        # Wait for the navigation to finish.
-        await page
+            # Wait for the navigation to finish.
+            await page
 
-        # Start background task to keep the fetch/XHR hook injected so that
+        # Keep the fetch/XHR hook injected across navigations so that
         # appointment availability polling can run autonomously.
-        asyncio.create_task(_ensure_fetch_hook(page))
+        await _ensure_fetch_hook(page)
     except Exception as _e:
         print(f"[WARN] Could not navigate to appointment page automatically – {_e}")
 
     print("[INFO] Navigated to appointment page. Waiting for user action… (Press Ctrl+C to exit)")
 
-    # Keep the coroutine – and therefore the browser – alive indefinitely
-    # so the user can carry out any manual steps.
-    while True:
-        await asyncio.sleep(3600)
+    # Keep the coroutine – and therefore the browser – alive until we are
+    # asked to stop, so the user can carry out any manual steps.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Not supported on Windows event loops; Ctrl+C still interrupts.
+            pass
+    await stop.wait()
+
+    print("[INFO] Shutting down browser…")
+    browser.stop()
 
 
 if __name__ == "__main__":